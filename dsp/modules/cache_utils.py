@@ -1,7 +1,10 @@
 import os
+import threading
 from functools import wraps
 from pathlib import Path
+from typing import Any, Optional
 
+import orjson
 from joblib import Memory
 
 from dsp.utils import dotdict
@@ -23,9 +26,23 @@ def noop_decorator(arg=None, *noop_args, **noop_kwargs):
         return decorator
 
 
+def json_dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serializes `obj` to compact JSON bytes."""
+    # non-string keys (e.g. the token ids of `logit_bias`) are written as strings, as `json` does
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return orjson.dumps(obj, option=option)
+
+
+def json_loads(data: bytes) -> Any:
+    return orjson.loads(data)
+
+
 cachedir = os.environ.get('DSP_CACHEDIR') or os.path.join(Path.home(), 'cachedir_joblib')
 CacheMemory = Memory(location=cachedir, verbose=0)
 
+# responses of async and batch requests, which joblib does not persist
+response_log_path = os.environ.get('DSP_RESPONSE_LOG') or os.path.join(cachedir, 'responses.jsonl')
+
 cachedir2 = os.environ.get('DSP_NOTEBOOK_CACHEDIR')
 NotebookCacheMemory = dotdict()
 NotebookCacheMemory.cache = noop_decorator
@@ -40,3 +57,68 @@ if not cache_turn_on:
 
     NotebookCacheMemory = dotdict()
     NotebookCacheMemory.cache = noop_decorator
+
+# API responses are cached in a single joblib layer: the notebook cache when it is configured, the global one otherwise
+ResponseCacheMemory = NotebookCacheMemory if cachedir2 else CacheMemory
+
+
+class ResponseLog:
+    """Append-only JSONL log of the API responses that joblib does not persist, by cache key.
+
+    Responses fetched by async and batch requests bypass joblib; logging them lets a later run
+    reuse them without paying for the same requests again. On open, the log is scanned into an
+    index of line offsets (reading only each record's key); responses are only parsed when looked
+    up. The file may be shared by several processes: records are written with single `O_APPEND`
+    writes, each on a line of its own, and a lookup checks that the record it read has its key.
+    """
+
+    # every record is written as `{"k":"<key>","r":<response>}`, so the key can be read without parsing
+    _KEY_PREFIX = b'{"k":"'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._writer = open(path, 'ab', buffering=0)
+        self._reader = open(path, 'rb')
+        self._scan()
+
+    def _scan(self):
+        offset = 0
+        for line in self._reader:
+            # a trailing line without a newline may be another process's record being written; skip it
+            if line.endswith(b'\n') and line.startswith(self._KEY_PREFIX):
+                end = line.find(b'"', len(self._KEY_PREFIX))
+                if end != -1:
+                    self._offsets[line[len(self._KEY_PREFIX):end].decode()] = offset
+            offset += len(line)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._offsets
+
+    def get(self, key: str) -> Optional[Any]:
+        offset = self._offsets.get(key)
+        if offset is None:
+            return None
+
+        with self._lock:
+            self._reader.seek(offset)
+            line = self._reader.readline()
+        try:
+            record = json_loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict) or record.get('k') != key:
+            return None
+        return record['r']
+
+    def append(self, key: str, response: Any):
+        # the leading newline keeps a record cut off by a crash from swallowing this one
+        line = b'\n' + json_dumps({'k': key, 'r': response}) + b'\n'
+        with self._lock:
+            self._writer.write(line)
+            os.fsync(self._writer.fileno())
+            # with O_APPEND the position after the write is the end of this record, wherever it landed
+            self._offsets[key] = self._writer.tell() - len(line) + 1
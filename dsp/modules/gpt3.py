@@ -1,15 +1,32 @@
-import functools
-import json
+import asyncio
+import contextlib
+import hashlib
+import heapq
+import importlib.util
+import io
 import logging
-from typing import Any, Literal, Optional, cast
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Callable, Literal, Optional, cast
 import uuid
 
 import backoff
+import httpx
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 import dsp
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
+from dsp.modules.cache_utils import (
+    ResponseCacheMemory,
+    ResponseLog,
+    cache_turn_on,
+    json_dumps,
+    json_loads,
+    response_log_path,
+)
 from dsp.modules.lm import LM
 
 try:
@@ -23,12 +40,37 @@ try:
 
     ERRORS = (
         openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
     )
 except Exception:
-    ERRORS = (openai.RateLimitError,)
+    ERRORS = (
+        openai.RateLimitError,
+        openai.InternalServerError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+    )
     OpenAIObject = dict
 
 
+# HTTP/2 multiplexing is used when the optional `h2` package is installed (`pip install httpx[http2]`)
+HTTP2 = importlib.util.find_spec("h2") is not None
+HTTP_LIMITS = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+
+def http_client(asynchronous: bool = False):
+    """Returns a pooled httpx client for OpenAI clients that keeps connections to the API alive."""
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client
+    return client_class(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT, follow_redirects=True)
+
+
+def async_client_factory(api_key: Optional[str], base_url: Optional[str]) -> Callable[[], AsyncOpenAI]:
+    """Returns a function creating `AsyncOpenAI` clients, each with its own pooled transport."""
+    return lambda: AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client(asynchronous=True))
+
+
 def backoff_hdlr(details):
     """Handler from https://pypi.org/project/backoff/"""
     print(
@@ -38,6 +80,233 @@ def backoff_hdlr(details):
     )
 
 
+# request fields that change with every call; everything else is hashed once per configuration
+QUERY_KEYS = ("messages", "prompt")
+
+
+def static_request_json(kwargs: dict[str, Any]) -> bytes:
+    """Returns the canonical JSON of the request fields other than the prompt or messages."""
+    return json_dumps({k: v for k, v in kwargs.items() if k not in QUERY_KEYS}, sort_keys=True)
+
+
+def static_request_hasher(static_json: bytes):
+    """Returns a BLAKE2b hasher primed with the `static_request_json` of a request."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(static_json)
+    hasher.update(b"\n")
+    return hasher
+
+
+def request_cache_key(kwargs: dict[str, Any], static_hasher=None) -> str:
+    """Returns the cache key for an API request, a 128-bit hex digest of its canonical JSON.
+
+    `static_hasher` is the `static_request_hasher` of the request's non-query fields; passing a
+    precomputed one leaves only the prompt or messages to serialize and hash.
+    """
+    if static_hasher is None:
+        static_hasher = static_request_hasher(static_request_json(kwargs))
+
+    hasher = static_hasher.copy()
+    hasher.update(json_dumps({k: kwargs[k] for k in QUERY_KEYS if k in kwargs}, sort_keys=True))
+    return hasher.hexdigest()
+
+
+# separates the demonstrations of a DSP prompt from its final query
+FEW_SHOT_SEPARATOR = "\n\n---\n\n"
+
+
+def request_prefix_key(kwargs: dict[str, Any]) -> Optional[str]:
+    """Returns a digest of an API request with its final query removed.
+
+    Requests that share instructions, demonstrations, system prompt and sampling parameters, and
+    differ only in what follows the last `FEW_SHOT_SEPARATOR` of the prompt, share a prefix key.
+    Prompts without a `FEW_SHOT_SEPARATOR` have no few-shot prefix, and get None.
+    """
+    kwargs = dict(kwargs)
+    if "messages" in kwargs:
+        *messages, last = kwargs["messages"]
+        prefix, separator, _ = last["content"].rpartition(FEW_SHOT_SEPARATOR)
+        kwargs["messages"] = [*messages, {**last, "content": prefix}]
+    else:
+        prefix, separator, _ = kwargs["prompt"].rpartition(FEW_SHOT_SEPARATOR)
+        kwargs["prompt"] = prefix
+
+    if not separator:
+        return None
+    return hashlib.blake2b(json_dumps(kwargs, sort_keys=True), digest_size=16).hexdigest()
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parses rate limit durations such as "20ms", "1.5s" or "6m0s" into seconds."""
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """Client-side request throttle shared by the sync and async paths of a `GPT3` client.
+
+    Requests are held back until the advertised reset when the latest response reported fewer
+    than `remaining_requests_threshold` requests left (`x-ratelimit-remaining-requests`), for
+    the duration of a `retry-after` header, and, if `max_requests_per_minute` is set, whenever
+    a sliding one-minute window of sent requests is full.
+    """
+
+    def __init__(self, max_requests_per_minute: Optional[int] = None, remaining_requests_threshold: int = 1):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.remaining_requests_threshold = remaining_requests_threshold
+        self._sent = deque()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, headers) -> None:
+        """Records the rate limit headers of an API response."""
+        now = time.monotonic()
+        delay = _parse_duration(headers.get("retry-after"))
+
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is not None and int(remaining) < self.remaining_requests_threshold:
+            reset = _parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset is not None:
+                delay = max(delay or 0.0, reset)
+
+        if delay:
+            with self._lock:
+                self._blocked_until = max(self._blocked_until, now + delay)
+
+    def reserve(self) -> float:
+        """Claims a slot for one request and returns how many seconds to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._blocked_until)
+
+            if self.max_requests_per_minute:
+                while self._sent and self._sent[0] <= start - 60:
+                    self._sent.popleft()
+                if len(self._sent) >= self.max_requests_per_minute:
+                    start = max(start, self._sent[-self.max_requests_per_minute] + 60)
+                self._sent.append(start)
+
+            return start - now
+
+    def wait(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def async_wait(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveConcurrencyLimiter:
+    """Async concurrency limit for API requests, adjusted by additive increase / multiplicative decrease.
+
+    Every `window` completed requests, the limit grows by one if their mean latency stayed within
+    `target_latency`, is halved if it exceeded 1.5x the target, and stays put in between. A rate
+    limit error halves it immediately.
+    """
+
+    def __init__(
+        self,
+        target_latency: float,
+        initial_limit: int = 32,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        window: int = 32,
+    ):
+        self.target_latency = target_latency
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self._in_flight = 0
+        self._latencies = []
+        self._waiters = deque()
+
+    async def acquire(self) -> None:
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self._in_flight += 1
+
+    def release(self, latency: float, rate_limited: bool = False) -> None:
+        self._in_flight -= 1
+
+        if rate_limited:
+            self._decrease()
+        else:
+            self._latencies.append(latency)
+            if len(self._latencies) >= self.window:
+                mean_latency = sum(self._latencies) / len(self._latencies)
+                # every window is judged on its own, including the ones that leave the limit unchanged
+                self._latencies = []
+                if mean_latency > 1.5 * self.target_latency:
+                    self._decrease()
+                elif mean_latency <= self.target_latency:
+                    self.limit = min(self.max_limit, self.limit + 1)
+
+        for _ in range(self.limit - self._in_flight):
+            if not self._waiters:
+                break
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _decrease(self) -> None:
+        self.limit = max(self.min_limit, int(self.limit * 0.5))
+        self._latencies = []
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.monotonic()
+        rate_limited = False
+        try:
+            yield
+        except openai.RateLimitError:
+            rate_limited = True
+            raise
+        finally:
+            self.release(time.monotonic() - start, rate_limited)
+
+
+def default_target_latency(model: str, max_tokens: int = 150) -> float:
+    """Latency (in seconds) that `AdaptiveConcurrencyLimiter` aims to stay under for `model`.
+
+    Latency is measured over the whole request, so the target allows for a fixed overhead plus
+    the time to generate `max_tokens` tokens.
+    """
+    if "gpt-3.5" in model:
+        return 0.5 + 0.02 * max_tokens
+    return 1.0 + 0.05 * max_tokens
+
+
+def _chat_choice_text(choice: dict[str, Any]) -> str:
+    return choice["message"]["content"]
+
+
+def _text_choice_text(choice: dict[str, Any]) -> str:
+    return choice["text"]
+
+
 class GPT3(LM):
     """Wrapper around OpenAI's GPT API.
 
@@ -46,6 +315,9 @@ class GPT3(LM):
         api_key (Optional[str], optional): API provider Authentication token. use Defaults to None.
         api_provider (Literal["openai"], optional): The API provider to use. Defaults to "openai".
         model_type (Literal["chat", "text"], optional): The type of model that was specified. Mainly to decide the optimal prompting strategy. Defaults to "text".
+        max_requests_per_minute (Optional[int], optional): Client-side cap on requests sent per minute. Defaults to None (only the API's rate limit headers are honored).
+        history_size (Optional[int], optional): Number of most recent requests kept in `history`. Defaults to 1024; None keeps all of them.
+        target_latency (Optional[float], optional): Seconds per async request above which the adaptive concurrency limit backs off. Defaults to None (estimated from the model and `max_tokens`).
         **kwargs: Additional arguments to pass to the API provider.
     """
 
@@ -57,6 +329,9 @@ class GPT3(LM):
         api_base: Optional[str] = None,
         model_type: Literal["chat", "text"] = None,
         system_prompt: Optional[str] = None,
+        max_requests_per_minute: Optional[int] = None,
+        history_size: Optional[int] = 1024,
+        target_latency: Optional[float] = None,
         **kwargs,
     ):
         super().__init__(model)
@@ -71,7 +346,7 @@ class GPT3(LM):
             if api_base:
                 openai.api_base = api_base
         else:
-            self.client = OpenAI(api_key=api_key, base_url=api_base)
+            self.client = OpenAI(api_key=api_key, base_url=api_base, http_client=http_client())
             self.client.api_type = api_provider
 
         self.system_prompt = system_prompt
@@ -87,6 +362,8 @@ class GPT3(LM):
             else "text"
         )
         self.model_type = model_type if model_type else default_model_type
+        # bound once here rather than branching on the model type for every returned choice
+        self._get_choice_text = _chat_choice_text if self.model_type == "chat" else _text_choice_text
 
         self.kwargs = {
             "temperature": 0.0,
@@ -99,10 +376,17 @@ class GPT3(LM):
         }  # TODO: add kwargs above for </s>
 
         self.kwargs["model"] = model
-        self.history: list[dict[str, Any]] = []
+        self.history: deque[dict[str, Any]] = deque(maxlen=history_size)
+        # (static JSON, hasher) of the latest request, swapped as one tuple so threads never mix them up
+        self._static_request = (None, None)
 
         # cached completions client
-        self.cache = CachedCompletions(self._openai_client())
+        self.cache = CachedCompletions(self._openai_client(), RateLimiter(max_requests_per_minute))
+        self.target_latency = target_latency or default_target_latency(model, self.kwargs["max_tokens"])
+        if not OPENAI_LEGACY:
+            self.async_cache = AsyncCachedCompletions(
+                async_client_factory(api_key, api_base), self.cache, AdaptiveConcurrencyLimiter(self.target_latency),
+            )
 
     def _openai_client(self):
         if OPENAI_LEGACY:
@@ -117,23 +401,45 @@ class GPT3(LM):
             total_tokens = usage_data.get("total_tokens")
             logging.info(f"{total_tokens}")
 
-    def basic_request(self, prompt: str, **kwargs):
-        raw_kwargs = kwargs
-
+    def _prepare_request(self, prompt: str, **kwargs):
         kwargs = {**self.kwargs, **kwargs}
         if self.model_type == "chat":
-            # caching mechanism requires hashable kwargs
-            messages = [{"role": "user", "content": prompt}]
             if self.system_prompt:
-                messages.insert(0, {"role": "system", "content": self.system_prompt})
-            kwargs["messages"] = [{"role": "user", "content": prompt}]
-            kwargs = {"stringify_request": json.dumps(kwargs)}
-            response = self.cache.chat_request(**kwargs)
-
+                kwargs["messages"] = [
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": prompt},
+                ]
+            else:
+                kwargs["messages"] = [{"role": "user", "content": prompt}]
         else:
             kwargs["prompt"] = prompt
-            response = self.cache.completions_request(**kwargs)
 
+        return kwargs
+
+    def _request_cache_key(self, kwargs: dict[str, Any]) -> str:
+        # the sampling parameters rarely change between calls, so hash them only when they do. They are
+        # compared as JSON rather than with ==, which would take 0, 0.0 and False for the same value
+        static_json = static_request_json(kwargs)
+        snapshot, static_hasher = self._static_request
+        if static_json != snapshot:
+            static_hasher = static_request_hasher(static_json)
+            self._static_request = (static_json, static_hasher)
+        return request_cache_key(kwargs, static_hasher)
+
+    def evict_prefix(self, prompt: str, **kwargs) -> int:
+        """Drops the in-process cached responses of every request sharing `prompt`'s few-shot prefix.
+
+        Useful to free memory once an optimizer has discarded a set of demonstrations. Only the
+        in-process LRU is affected: the copies persisted by joblib and the response log are kept,
+        so repeating one of these requests is still served from disk (and indexed again). Returns
+        the number of responses dropped, 0 if `prompt` has no few-shot prefix.
+        """
+        prefix_key = request_prefix_key(self._prepare_request(prompt, **kwargs))
+        if prefix_key is None:
+            return 0
+        return evict_prefix(prefix_key)
+
+    def _log_history(self, prompt: str, response, kwargs, raw_kwargs):
         history = {
             "prompt": prompt,
             "response": response,
@@ -142,12 +448,45 @@ class GPT3(LM):
         }
         self.history.append(history)
 
+    def basic_request(self, prompt: str, **kwargs):
+        raw_kwargs = kwargs
+
+        kwargs = self._prepare_request(prompt, **kwargs)
+        cache_key = self._request_cache_key(kwargs)
+        if self.model_type == "chat":
+            response = self.cache.chat_request(cache_key, kwargs)
+        else:
+            response = self.cache.completions_request(cache_key, kwargs)
+
+        self._log_history(prompt, response, kwargs, raw_kwargs)
+
+        return response
+
+    async def abasic_request(self, prompt: str, **kwargs):
+        if OPENAI_LEGACY:
+            return await asyncio.to_thread(self.basic_request, prompt, **kwargs)
+
+        return await self._abasic_request(self.async_cache, prompt, **kwargs)
+
+    async def _abasic_request(self, async_cache: "AsyncCachedCompletions", prompt: str, **kwargs):
+        raw_kwargs = kwargs
+
+        kwargs = self._prepare_request(prompt, **kwargs)
+        cache_key = self._request_cache_key(kwargs)
+        if self.model_type == "chat":
+            response = await async_cache.chat_request(cache_key, kwargs)
+        else:
+            response = await async_cache.completions_request(cache_key, kwargs)
+
+        self._log_history(prompt, response, kwargs, raw_kwargs)
+
         return response
 
     @backoff.on_exception(
         backoff.expo,
         ERRORS,
         max_time=1000,
+        jitter=backoff.full_jitter,
         on_backoff=backoff_hdlr,
     )
     def request(self, prompt: str, **kwargs):
@@ -157,10 +496,19 @@ class GPT3(LM):
 
         return self.basic_request(prompt, **kwargs)
 
-    def _get_choice_text(self, choice: dict[str, Any]) -> str:
-        if self.model_type == "chat":
-            return choice["message"]["content"]
-        return choice["text"]
+    @backoff.on_exception(
+        backoff.expo,
+        ERRORS,
+        max_time=1000,
+        jitter=backoff.full_jitter,
+        on_backoff=backoff_hdlr,
+    )
+    async def arequest(self, prompt: str, **kwargs):
+        """Async counterpart of `request`."""
+        if "model_type" in kwargs:
+            del kwargs["model_type"]
+
+        return await self.abasic_request(prompt, **kwargs)
 
     def __call__(
         self,
@@ -191,113 +539,623 @@ class GPT3(LM):
 
         response = self.request(prompt, **kwargs)
 
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def acall(
+        self,
+        prompt: str,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
+        """Async counterpart of `__call__`."""
+
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        response = await self.arequest(prompt, **kwargs)
+
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def _one(self, prompt: str, sem: asyncio.Semaphore, **kwargs):
+        async with sem:
+            return await self.acall(prompt, **kwargs)
+
+    async def abatch(
+        self,
+        prompts: list[str],
+        concurrency_limit: Optional[int] = None,
+        **kwargs,
+    ) -> list[list[dict[str, Any]]]:
+        """Retrieves completions for several prompts concurrently.
+
+        Requests that miss the cache are limited by the client's `AdaptiveConcurrencyLimiter`,
+        which backs off when the API slows down or rate limits.
+
+        Args:
+            prompts (list[str]): prompts to send to GPT-3
+            concurrency_limit (Optional[int], optional): fixed cap on prompts in flight at once, on top of the adaptive limit. Defaults to None.
+            **kwargs: passed through to `acall` for every prompt.
+
+        Returns:
+            list[list[dict[str, Any]]]: completion choices for each prompt, in the order of `prompts`
+        """
+        if not OPENAI_LEGACY and self.async_cache.batch is not None:
+            tasks = [asyncio.ensure_future(self.acall(p, **kwargs)) for p in prompts]
+            pending = set(tasks)
+            while pending:
+                # flush once every unfinished task waits on the batch, however long it takes to get there
+                if self.async_cache.batch_waiters >= len(pending):
+                    await self.flush_batch()
+                _, pending = await asyncio.wait(pending, timeout=0.01)
+            return await asyncio.gather(*tasks)
+
+        if concurrency_limit is None:
+            return await asyncio.gather(*[self.acall(p, **kwargs) for p in prompts])
+
+        sem = asyncio.Semaphore(concurrency_limit)
+        return await asyncio.gather(*[self._one(p, sem, **kwargs) for p in prompts])
+
+    def batch_mode(self, enabled: bool = True) -> None:
+        """Toggles offline batching of async requests through the OpenAI Batch API.
+
+        While enabled, async requests that miss the cache are held back until `flush_batch`
+        submits them together as a single batch job, which is billed at a lower rate but may take
+        up to 24 hours to complete. `abatch` flushes automatically.
+        """
+        if OPENAI_LEGACY:
+            raise NotImplementedError("Batch mode requires openai>=1.0.")
+
+        self.async_cache.batch = {} if enabled else None
+
+    async def flush_batch(self, poll_interval: float = 30.0) -> None:
+        """Submits the requests held back in batch mode and waits for the batch job to finish.
+
+        Failed requests raise in the coroutines awaiting them rather than here.
+        """
+        endpoint = "/v1/chat/completions" if self.model_type == "chat" else "/v1/completions"
+        await self.async_cache.flush_batch(endpoint, poll_interval)
+
+    def _get_completions(self, response, only_completed: bool, return_sorted: bool, **kwargs):
         if dsp.settings.log_openai_usage:
             self.log_usage(response)
 
-        choices = response["choices"]
+        # one pass over the choices, keeping truncated ones aside in case none completed
+        ranked = return_sorted and kwargs.get("n", 1) > 1
+        completed, truncated = [], []
+        for c in response["choices"]:
+            text = self._get_choice_text(c)
+            entry = (self._mean_logprob(c), text) if ranked else text
+            (truncated if only_completed and c["finish_reason"] == "length" else completed).append(entry)
 
-        completed_choices = [c for c in choices if c["finish_reason"] != "length"]
+        completions = completed or truncated
+        if ranked:
+            completions = [text for _, text in heapq.nlargest(len(completions), completions)]
 
-        if only_completed and len(completed_choices):
-            choices = completed_choices
+        return completions
 
-        completions = [self._get_choice_text(c) for c in choices]
-        if return_sorted and kwargs.get("n", 1) > 1:
-            scored_completions = []
+    @staticmethod
+    def _mean_logprob(choice: dict[str, Any]) -> float:
+        tokens, logprobs = choice["logprobs"]["tokens"], choice["logprobs"]["token_logprobs"]
+        if "<|endoftext|>" in tokens:
+            logprobs = logprobs[: tokens.index("<|endoftext|>") + 1]
+        return sum(logprobs) / len(logprobs)
 
-            for c in choices:
-                tokens, logprobs = (
-                    c["logprobs"]["tokens"],
-                    c["logprobs"]["token_logprobs"],
-                )
 
-                if "<|endoftext|>" in tokens:
-                    index = tokens.index("<|endoftext|>") + 1
-                    tokens, logprobs = tokens[:index], logprobs[:index]
+class GPT3Pool(GPT3):
+    """`GPT3` that spreads `abatch` across several OpenAI-compatible endpoints.
 
-                avglog = sum(logprobs) / len(logprobs)
-                scored_completions.append((avglog, self._get_choice_text(c)))
+    Prompts go into a shared queue drained by `workers_per_endpoint` workers per endpoint, so
+    faster endpoints naturally take on more of the batch. An endpoint that fails with a rate
+    limit, server or connection error cools down for its `retry-after` (or `cooldown` seconds)
+    and the prompt is re-queued for any endpoint to pick up. Synchronous calls use the first
+    endpoint.
 
-            scored_completions = sorted(scored_completions, reverse=True)
-            completions = [c for _, c in scored_completions]
+    Args:
+        endpoints (list[dict[str, str]]): `api_key` and `base_url` of each endpoint.
+        model (str, optional): Model to use on every endpoint. Defaults to "gpt-3.5-turbo-instruct".
+        workers_per_endpoint (int, optional): Number of concurrent requests per endpoint. Defaults to 8.
+        cooldown (float, optional): Seconds an endpoint rests after a failure without `retry-after`. Defaults to 5.
+        max_attempts (int, optional): Number of tries per prompt before giving up. Defaults to 10.
+        max_requests_per_minute (Optional[int], optional): Client-side cap on requests sent per minute to each endpoint. Defaults to None.
+        **kwargs: Additional arguments passed to `GPT3`.
+    """
 
-        return completions
+    def __init__(
+        self,
+        endpoints: list[dict[str, str]],
+        model: str = "gpt-3.5-turbo-instruct",
+        workers_per_endpoint: int = 8,
+        cooldown: float = 5.0,
+        max_attempts: int = 10,
+        max_requests_per_minute: Optional[int] = None,
+        **kwargs,
+    ):
+        if OPENAI_LEGACY:
+            raise NotImplementedError("GPT3Pool requires openai>=1.0.")
+        assert endpoints, "GPT3Pool needs at least one endpoint."
+
+        super().__init__(
+            model=model,
+            api_key=endpoints[0].get("api_key"),
+            api_base=endpoints[0].get("base_url"),
+            max_requests_per_minute=max_requests_per_minute,
+            **kwargs,
+        )
+        self.endpoint_configs = endpoints
+        self.workers_per_endpoint = workers_per_endpoint
+        self.cooldown = cooldown
+        self.max_attempts = max_attempts
+        self.max_requests_per_minute = max_requests_per_minute
+
+        self.endpoints = [self.async_cache]
+        for endpoint in endpoints[1:]:
+            client = OpenAI(
+                api_key=endpoint.get("api_key"), base_url=endpoint.get("base_url"), http_client=http_client(),
+            )
+            self.endpoints.append(
+                AsyncCachedCompletions(
+                    async_client_factory(endpoint.get("api_key"), endpoint.get("base_url")),
+                    CachedCompletions(client, RateLimiter(max_requests_per_minute)),
+                    AdaptiveConcurrencyLimiter(self.target_latency),
+                ),
+            )
+        self._cooldown_until = [0.0] * len(self.endpoints)
+
+    def copy(self, **kwargs):
+        """Returns a copy of the pool over the same endpoints, with the same parameters."""
+        kwargs = {**self.kwargs, **kwargs}
+        model = kwargs.pop("model")
+
+        return self.__class__(
+            endpoints=self.endpoint_configs,
+            model=model,
+            workers_per_endpoint=self.workers_per_endpoint,
+            cooldown=self.cooldown,
+            max_attempts=self.max_attempts,
+            max_requests_per_minute=self.max_requests_per_minute,
+            **kwargs,
+        )
 
+    async def _worker(
+        self,
+        index: int,
+        queue: asyncio.Queue,
+        results: list,
+        sem: asyncio.Semaphore,
+        only_completed,
+        return_sorted,
+        **kwargs,
+    ):
+        async_cache = self.endpoints[index]
+        while True:
+            # sit out the cooldown before taking work, so healthy endpoints drain the queue meanwhile
+            delay = self._cooldown_until[index] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            position, prompt, attempt = await queue.get()
+            try:
+                # the endpoint may have started cooling down while this worker waited on the queue
+                if self._cooldown_until[index] > time.monotonic():
+                    queue.put_nowait((position, prompt, attempt))
+                    continue
+
+                async with sem:
+                    response = await self._abasic_request(async_cache, prompt, **kwargs)
+                results[position] = self._get_completions(response, only_completed, return_sorted, **kwargs)
+            except ERRORS as e:
+                # requests in flight when the endpoint failed don't count as another attempt
+                cooling = self._cooldown_until[index] > time.monotonic()
+                retry_after = None
+                if isinstance(e, openai.APIStatusError):
+                    retry_after = _parse_duration(e.response.headers.get("retry-after"))
+                self._cooldown_until[index] = time.monotonic() + (retry_after or self.cooldown)
+
+                if cooling:
+                    queue.put_nowait((position, prompt, attempt))
+                elif attempt + 1 < self.max_attempts:
+                    queue.put_nowait((position, prompt, attempt + 1))
+                else:
+                    results[position] = e
+            except Exception as e:
+                results[position] = e
+            finally:
+                queue.task_done()
+
+    async def abatch(
+        self,
+        prompts: list[str],
+        concurrency_limit: Optional[int] = None,
+        *,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[list[dict[str, Any]]]:
+        """Retrieves completions for several prompts, spread across all endpoints of the pool.
 
-import functools
-import weakref
+        Args:
+            prompts (list[str]): prompts to send
+            concurrency_limit (Optional[int], optional): cap on prompts in flight at once across the pool. Defaults to None (one per worker).
+            only_completed (bool, optional): return only completed responses and ignores completion due to length. Defaults to True.
+            return_sorted (bool, optional): sort the completion choices using the returned probabilities. Defaults to False.
+            **kwargs: Additional arguments to pass to the API provider.
 
-def weak_lru(maxsize=128, typed=False):
-    'LRU Cache decorator that keeps a weak reference to "self"'
-    def wrapper(func):
+        Returns:
+            list[list[dict[str, Any]]]: completion choices for each prompt, in the order of `prompts`
+        """
+        if self.async_cache.batch is not None:
+            return await super().abatch(
+                prompts, concurrency_limit, only_completed=only_completed, return_sorted=return_sorted, **kwargs,
+            )
 
-        @functools.lru_cache(maxsize, typed)
-        def _func(_self, *args, **kwargs):
-            return func(_self(), *args, **kwargs)
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
 
-        @functools.wraps(func)
-        def inner(self, *args, **kwargs):
-            return _func(weakref.ref(self), *args, **kwargs)
+        queue = asyncio.Queue()
+        for position, prompt in enumerate(prompts):
+            queue.put_nowait((position, prompt, 0))
+
+        results = [None] * len(prompts)
+        sem = asyncio.Semaphore(concurrency_limit or len(self.endpoints) * self.workers_per_endpoint)
+        workers = [
+            asyncio.ensure_future(self._worker(index, queue, results, sem, only_completed, return_sorted, **kwargs))
+            for index in range(len(self.endpoints))
+            for _ in range(self.workers_per_endpoint)
+        ]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+_CLIENTS: "weakref.WeakValueDictionary[int, OpenAI]" = weakref.WeakValueDictionary()
+_RATE_LIMITERS: "weakref.WeakValueDictionary[int, RateLimiter]" = weakref.WeakValueDictionary()
+
+# process-wide LRU of responses by cache key, checked before the joblib caches
+RESPONSE_LRU_SIZE = 4096
+_response_lru: "OrderedDict[str, Any]" = OrderedDict()
+_response_lru_lock = threading.Lock()
+# keys of the responses in the LRU, grouped by request prefix so a few-shot set can be evicted at once
+_prefix_index: dict[str, set[str]] = {}
+_prefix_of: dict[str, str] = {}
+
+
+def _lru_get(cache_key: str):
+    with _response_lru_lock:
+        response = _response_lru.get(cache_key)
+        if response is not None:
+            _response_lru.move_to_end(cache_key)
+        return response
 
-        return inner
 
-    return wrapper
+def _lru_put(cache_key: str, response, prefix_key: Optional[str] = None):
+    if not cache_turn_on:
+        return
+
+    with _response_lru_lock:
+        _response_lru[cache_key] = response
+        _response_lru.move_to_end(cache_key)
+        if prefix_key is not None:
+            _prefix_index.setdefault(prefix_key, set()).add(cache_key)
+            _prefix_of[cache_key] = prefix_key
+        if len(_response_lru) > RESPONSE_LRU_SIZE:
+            evicted_key, _ = _response_lru.popitem(last=False)
+            _unindex_prefix(evicted_key)
+
+
+def _unindex_prefix(cache_key: str):
+    prefix_key = _prefix_of.pop(cache_key, None)
+    if prefix_key is not None:
+        keys = _prefix_index[prefix_key]
+        keys.discard(cache_key)
+        if not keys:
+            del _prefix_index[prefix_key]
+
+
+def evict_prefix(prefix_key: str) -> int:
+    """Drops every in-process cached response whose request has the given prefix key.
+
+    The response log and disk cache are left untouched, so the requests are served from disk (and
+    indexed again) if they are repeated. Returns the number of responses dropped.
+    """
+    with _response_lru_lock:
+        keys = _prefix_index.pop(prefix_key, set())
+        for cache_key in keys:
+            _response_lru.pop(cache_key, None)
+            _prefix_of.pop(cache_key, None)
+    return len(keys)
+
+
+# process-wide log of responses, opened by the first CachedCompletions
+_response_log: Optional[ResponseLog] = None
+_response_log_lock = threading.Lock()
+
+
+def _open_response_log() -> Optional[ResponseLog]:
+    global _response_log
+
+    if cache_turn_on:
+        with _response_log_lock:
+            if _response_log is None:
+                _response_log = ResponseLog(response_log_path)
+    return _response_log
+
+
+def _cached_response(cache_key: str, api_kwargs: dict[str, Any]):
+    response = _lru_get(cache_key)
+    if response is None and _response_log is not None:
+        response = _response_log.get(cache_key)
+        if response is not None:
+            # indexed like a fresh response, so `evict_prefix` can drop it again
+            _store_response(cache_key, api_kwargs, response)
+    return response
+
+
+def _store_response(cache_key: str, api_kwargs: dict[str, Any], response):
+    _lru_put(cache_key, response, request_prefix_key(api_kwargs))
+
+
+async def _log_response(cache_key: str, response):
+    """Persists a response that bypassed joblib to the response log, off the event loop."""
+    if _response_log is not None and cache_key not in _response_log:
+        await asyncio.to_thread(_response_log.append, cache_key, response)
+
+
+class StreamedResponse:
+    """Assembles the chunks of a streamed (`stream=True`) completion into a regular response dict.
+
+    `add` reports when every one of the `n` choices has a `finish_reason`, so the caller can close
+    the stream right away instead of waiting for the trailing chunks.
+    """
+
+    def __init__(self, n: int = 1):
+        self.n = n
+        self.response = {}
+        self.choices: dict[int, dict[str, Any]] = {}
+
+    def add(self, chunk) -> bool:
+        if not self.response:
+            self.response = {"id": chunk.id, "created": chunk.created, "model": chunk.model, "usage": None}
+
+        for delta in chunk.choices:
+            choice = self.choices.setdefault(delta.index, {"index": delta.index, "finish_reason": None})
+            if hasattr(delta, "delta"):
+                message = choice.setdefault("message", {"role": "assistant", "content": ""})
+                message["content"] += delta.delta.content or ""
+            else:
+                choice["text"] = choice.get("text", "") + (delta.text or "")
+                choice["logprobs"] = None
+            if delta.finish_reason is not None:
+                choice["finish_reason"] = delta.finish_reason
+
+        return len(self.choices) >= self.n and all(c["finish_reason"] for c in self.choices.values())
+
+    def result(self) -> dict[str, Any]:
+        choices = [self.choices[index] for index in sorted(self.choices)]
+        chat = any("message" in choice for choice in choices)
+        return {**self.response, "object": "chat.completion" if chat else "text_completion", "choices": choices}
+
+
+def v1_throttled_request(client_id: int, resource, kwargs: dict[str, Any]) -> dict[str, Any]:
+    """Sends a request through `resource.with_raw_response` so the rate limiter sees the headers."""
+    rate_limiter = _RATE_LIMITERS[client_id]
+    rate_limiter.wait()
+    try:
+        raw_response = resource.with_raw_response.create(**kwargs)
+    except openai.APIStatusError as e:
+        rate_limiter.update(e.response.headers)
+        raise
+
+    rate_limiter.update(raw_response.headers)
+    response = raw_response.parse()
+    if not kwargs.get("stream"):
+        return response.model_dump()
+
+    streamed = StreamedResponse(kwargs.get("n", 1))
+    try:
+        for chunk in response:
+            if streamed.add(chunk):
+                break
+    finally:
+        response.close()
+    return streamed.result()
+
+
+@ResponseCacheMemory.cache(ignore=['client_id', 'api_kwargs', 'chat'])
+def cached_gpt3_request(client_id: int, cache_key: str, api_kwargs: dict[str, Any], chat: bool):
+    if OPENAI_LEGACY:
+        if chat:
+            return cast(OpenAIObject, openai.ChatCompletion.create(**api_kwargs))
+        return openai.Completion.create(**api_kwargs)
+
+    client = _CLIENTS[client_id]
+    return v1_throttled_request(client_id, client.chat.completions if chat else client.completions, api_kwargs)
+
+
+def _disk_cached_response(client_id: int, cache_key: str, api_kwargs: dict[str, Any], chat: bool):
+    """Returns the response joblib has cached for a request, or None without calling the API."""
+    if not cached_gpt3_request.check_call_in_cache(client_id, cache_key, api_kwargs, chat):
+        return None
+    return cached_gpt3_request(client_id, cache_key, api_kwargs, chat)
+
 
 class CachedCompletions:
-    def __init__(self, client: OpenAI):
-        # generate uuid for cache
+    def __init__(self, client: OpenAI, rate_limiter: Optional[RateLimiter] = None):
         self.client = client
-        self.cache_gpt3_request_v2 = CacheMemory.cache(self.cached_gpt3_request_v2, ignore=['self'])
-        self.cached_gpt3_request_v2_wrapped = NotebookCacheMemory.cache(self.cached_gpt3_request_v2_wrapped, ignore=['self'])
-        self._cached_gpt3_turbo_request_v2 = CacheMemory.cache(self._cached_gpt3_turbo_request_v2, ignore=['self'])
-        self._cached_gpt3_turbo_request_v2_wrapped = NotebookCacheMemory.cache(self._cached_gpt3_turbo_request_v2_wrapped, ignore=['self'])
-        self.v1_cached_gpt3_request_v2 = CacheMemory.cache(self.v1_cached_gpt3_request_v2, ignore=['self'])
-        self.v1_cached_gpt3_request_v2_wrapped = NotebookCacheMemory.cache(self.v1_cached_gpt3_request_v2_wrapped, ignore=['self'])
-        self.v1_cached_gpt3_turbo_request_v2 = CacheMemory.cache(self.v1_cached_gpt3_turbo_request_v2, ignore=['self'])
-        self.v1_cached_gpt3_turbo_request_v2_wrapped = NotebookCacheMemory.cache(self.v1_cached_gpt3_turbo_request_v2_wrapped, ignore=['self'])
-
-    def cached_gpt3_request_v2(self, **kwargs):
-        del kwargs["model_uuid"]
-        return self.client.Completion.create(**kwargs)
-
-    @weak_lru(maxsize=None if cache_turn_on else 0)
-    def cached_gpt3_request_v2_wrapped(self, **kwargs):
-        return self.cached_gpt3_request_v2(**kwargs)
-
-    def _cached_gpt3_turbo_request_v2(self, **kwargs) -> OpenAIObject:
-        if "stringify_request" in kwargs:
-            kwargs = json.loads(kwargs["stringify_request"])
-        return cast(OpenAIObject, openai.ChatCompletion.create(**kwargs))
-
-    @weak_lru(maxsize=None if cache_turn_on else 0)
-    def _cached_gpt3_turbo_request_v2_wrapped(self, **kwargs) -> OpenAIObject:
-        return self._cached_gpt3_turbo_request_v2(**kwargs)
-
-    def v1_cached_gpt3_request_v2(self, **kwargs):
-        del kwargs["model_uuid"]
-        return self.client.completions.create(**kwargs)
-
-    @weak_lru(maxsize=None if cache_turn_on else 0)
-    def v1_cached_gpt3_request_v2_wrapped(self, **kwargs):
-        return self.v1_cached_gpt3_request_v2(**kwargs)
-
-    def v1_cached_gpt3_turbo_request_v2(self, **kwargs):
-        if "stringify_request" in kwargs:
-            kwargs = json.loads(kwargs["stringify_request"])
-        return self.client.chat.completions.create(**kwargs)
-
-    @weak_lru(maxsize=None if cache_turn_on else 0)
-    def v1_cached_gpt3_turbo_request_v2_wrapped(self, **kwargs):
-        return self.v1_cached_gpt3_turbo_request_v2(**kwargs)
-
-    def chat_request(self, **kwargs):
-        if OPENAI_LEGACY:
-            return self._cached_gpt3_turbo_request_v2_wrapped(**kwargs)
+        self.client_id = id(client)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.response_log = _open_response_log()
+        if not OPENAI_LEGACY:
+            _CLIENTS[self.client_id] = client
+            _RATE_LIMITERS[self.client_id] = self.rate_limiter
+
+    def request(self, cache_key: str, api_kwargs: dict[str, Any], chat: bool):
+        response = _cached_response(cache_key, api_kwargs)
+        if response is None:
+            response = cached_gpt3_request(self.client_id, cache_key, api_kwargs, chat)
+            _store_response(cache_key, api_kwargs, response)
+        return response
 
-        return self.v1_cached_gpt3_turbo_request_v2_wrapped(**kwargs).model_dump()
+    def chat_request(self, cache_key: str, api_kwargs: dict[str, Any]):
+        return self.request(cache_key, api_kwargs, chat=True)
 
-    def completions_request(self, **kwargs):
-        if OPENAI_LEGACY:
-            return self.cached_gpt3_request_v2_wrapped(**kwargs)
+    def completions_request(self, cache_key: str, api_kwargs: dict[str, Any]):
+        return self.request(cache_key, api_kwargs, chat=False)
+
+
+class AsyncCachedCompletions:
+    """Async counterpart of `CachedCompletions`, used by `GPT3.abatch`.
+
+    Shares the in-process LRU, response log and disk cache with the synchronous client; only
+    misses go through `AsyncOpenAI`, and since those bypass joblib they go to the response log.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], AsyncOpenAI],
+        cache: CachedCompletions,
+        concurrency: Optional[AdaptiveConcurrencyLimiter] = None,
+    ):
+        self.client_factory = client_factory
+        # one client per event loop: pooled connections are bound to the loop that opened them
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.cache = cache
+        self.concurrency = concurrency or AdaptiveConcurrencyLimiter(default_target_latency(""))
+        # requests waiting for the next batch job by cache key, or None outside batch mode
+        self.batch: Optional[dict[str, tuple[dict[str, Any], asyncio.Future]]] = None
+        # number of requests currently waiting on a batch job
+        self.batch_waiters = 0
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """The `AsyncOpenAI` client of the running event loop, created on first use."""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self.client_factory()
+        return client
+
+    async def v1_throttled_request(self, resource, kwargs: dict[str, Any]) -> dict[str, Any]:
+        rate_limiter = self.cache.rate_limiter
+        await rate_limiter.async_wait()
+        try:
+            async with self.concurrency.slot():
+                raw_response = await resource.with_raw_response.create(**kwargs)
+                rate_limiter.update(raw_response.headers)
+                response = raw_response.parse()
+                if not kwargs.get("stream"):
+                    return response.model_dump()
+
+                streamed = StreamedResponse(kwargs.get("n", 1))
+                try:
+                    async for chunk in response:
+                        if streamed.add(chunk):
+                            break
+                finally:
+                    await response.close()
+                return streamed.result()
+        except openai.APIStatusError as e:
+            rate_limiter.update(e.response.headers)
+            raise
+
+    async def batched_request(self, cache_key: str, api_kwargs: dict[str, Any]):
+        if cache_key not in self.batch:
+            self.batch[cache_key] = (api_kwargs, asyncio.get_running_loop().create_future())
+
+        self.batch_waiters += 1
+        try:
+            return await self.batch[cache_key][1]
+        finally:
+            self.batch_waiters -= 1
+
+    async def _run_batch(self, endpoint: str, requests: dict[str, dict[str, Any]], poll_interval: float):
+        lines = b"".join(
+            json_dumps({"custom_id": cache_key, "method": "POST", "url": endpoint, "body": api_kwargs}) + b"\n"
+            for cache_key, api_kwargs in requests.items()
+        )
+        batch_file = await self.client.files.create(file=("batch.jsonl", io.BytesIO(lines)), purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id, endpoint=endpoint, completion_window="24h",
+        )
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        records = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if line:
+                    record = json_loads(line)
+                    records[record["custom_id"]] = record
+
+        return batch, records
+
+    async def flush_batch(self, endpoint: str, poll_interval: float = 30.0) -> None:
+        pending, self.batch = self.batch, {}
+        if not pending:
+            return
+
+        try:
+            batch, records = await self._run_batch(
+                endpoint, {cache_key: api_kwargs for cache_key, (api_kwargs, _) in pending.items()}, poll_interval,
+            )
+        except Exception as e:
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for cache_key, (_, future) in pending.items():
+            record = records.get(cache_key)
+            if future.done():
+                continue
+            elif record is None:
+                future.set_exception(
+                    RuntimeError(f"Batch {batch.id} ended with status {batch.status!r} without a result for {cache_key}"),
+                )
+            elif record.get("error") or record["response"]["status_code"] != 200:
+                future.set_exception(
+                    RuntimeError(f"Batch request {cache_key} failed: {record.get('error') or record['response']}"),
+                )
+            else:
+                future.set_result(record["response"]["body"])
+
+    async def request(self, cache_key: str, api_kwargs: dict[str, Any], chat: bool):
+        response = _cached_response(cache_key, api_kwargs)
+        if response is not None:
+            return response
+
+        if hasattr(cached_gpt3_request, "check_call_in_cache"):
+            # joblib reads from disk, so it runs off the event loop
+            response = await asyncio.to_thread(_disk_cached_response, self.cache.client_id, cache_key, api_kwargs, chat)
+        if response is None:
+            if self.batch is not None:
+                response = await self.batched_request(cache_key, api_kwargs)
+            else:
+                resource = self.client.chat.completions if chat else self.client.completions
+                response = await self.v1_throttled_request(resource, api_kwargs)
+            await _log_response(cache_key, response)
+
+        _store_response(cache_key, api_kwargs, response)
+
+        return response
+
+    async def chat_request(self, cache_key: str, api_kwargs: dict[str, Any]):
+        return await self.request(cache_key, api_kwargs, chat=True)
 
-        return self.v1_cached_gpt3_request_v2_wrapped(**kwargs).model_dump()
\ No newline at end of file
+    async def completions_request(self, cache_key: str, api_kwargs: dict[str, Any]):
+        return await self.request(cache_key, api_kwargs, chat=False)
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from itertools import islice
 
 
 class LM(ABC):
@@ -42,7 +43,7 @@ class LM(ABC):
         printed = []
         n = n + skip
 
-        for x in reversed(self.history[-100:]):
+        for x in islice(reversed(self.history), 100):
             prompt = x["prompt"]
 
             if prompt != last_prompt:
@@ -0,0 +1,38 @@
+from dsp.modules.cache_utils import ResponseLog
+
+
+def test_response_log_resumes_from_disk(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+
+    log = ResponseLog(path)
+    log.append("a", {"choices": [1]})
+    log.append("b", {"choices": [2]})
+
+    # simulate a crash in the middle of writing a third record
+    with open(path, "ab") as f:
+        f.write(b'{"k":"c","r":{"cho')
+
+    resumed = ResponseLog(path)
+    assert "a" in resumed and "b" in resumed and "c" not in resumed
+    assert resumed.get("b") == {"choices": [2]}
+
+    resumed.append("c", {"choices": [3]})
+    assert ResponseLog(path).get("c") == {"choices": [3]}
+    assert ResponseLog(path).get("a") == {"choices": [1]}
+
+
+def test_response_log_shared_between_writers(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+
+    first, second = ResponseLog(path), ResponseLog(path)
+    first.append("a", {"choices": [1]})
+    second.append("b", {"choices": [2]})
+    first.append("c", {"choices": [3]})
+
+    assert first.get("c") == {"choices": [3]}
+    assert second.get("b") == {"choices": [2]}
+    assert ResponseLog(path).get("a") == {"choices": [1]}
+
+    # a stale offset pointing at another record is never served as this key's response
+    first._offsets["d"] = first._offsets["a"]
+    assert first.get("d") is None
@@ -1,4 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import orjson
+import pytest
+from joblib import Memory
+
 import dspy
+from dsp.modules import gpt3
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """Points the response caches at `tmp_path`, so fake responses never reach the user's cache directory."""
+    monkeypatch.setattr(gpt3, "_response_lru", gpt3.OrderedDict())
+    monkeypatch.setattr(gpt3, "_prefix_index", {})
+    monkeypatch.setattr(gpt3, "_prefix_of", {})
+    monkeypatch.setattr(gpt3, "_response_log", None)
+    monkeypatch.setattr(gpt3, "response_log_path", str(tmp_path / "responses.jsonl"))
+
+    cached_request = gpt3.cached_gpt3_request
+    memory = Memory(location=str(tmp_path / "joblib"), verbose=0)
+    monkeypatch.setattr(gpt3, "cached_gpt3_request", memory.cache(cached_request.func, ignore=cached_request.ignore))
+
+
+def _fake_chat(create):
+    """Returns a stand-in for `OpenAI.chat` whose raw-response `create` calls `create`."""
+    completions = SimpleNamespace(create=create)
+    completions.with_raw_response = completions
+    return SimpleNamespace(completions=completions)
+
+
+def _fake_async_client(async_cache, client):
+    """Makes `async_cache` use `client` as its `AsyncOpenAI` client on every event loop."""
+    async_cache.client_factory = lambda: client
+
+
+def _fake_async_chat(async_cache, completions):
+    _fake_async_client(async_cache, SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+
 
 def test_multiple_clients():
     local_api_base = "http://localhost/v1/"
@@ -15,4 +56,515 @@ def test_multiple_clients():
     assert openai_local.client.api_key == local_api_key
 
     assert str(openai_local.client.base_url) == local_api_base
-    assert openai_client.client.base_url != local_api_base
\ No newline at end of file
+    assert openai_client.client.base_url != local_api_base
+
+class _FakeResponse:
+    headers = {}
+
+    def __init__(self, content):
+        self.content = content
+
+    def parse(self):
+        return self
+
+    def model_dump(self):
+        return {
+            "choices": [{"finish_reason": "stop", "message": {"role": "assistant", "content": self.content}}],
+            "usage": {"total_tokens": 1},
+        }
+
+
+class _FakeChatCompletions:
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.with_raw_response = self
+
+    async def create(self, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return _FakeResponse(kwargs["messages"][-1]["content"].upper())
+
+
+def test_abatch_fans_out_concurrently():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    completions = _FakeChatCompletions()
+    _fake_async_chat(lm.async_cache, completions)
+
+    prompts = [f"prompt {i}" for i in range(8)]
+    results = asyncio.run(lm.abatch(prompts, concurrency_limit=4))
+
+    assert results == [[p.upper()] for p in prompts]
+    assert 1 < completions.max_in_flight <= 4
+    assert len(lm.history) == len(prompts)
+
+
+def test_abatch_is_capped_by_the_adaptive_limit_only():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    completions = _FakeChatCompletions()
+    _fake_async_chat(lm.async_cache, completions)
+    lm.async_cache.concurrency.limit = 40
+
+    prompts = [f"prompt {i}" for i in range(48)]
+    asyncio.run(lm.abatch(prompts))
+
+    assert completions.max_in_flight == 40
+
+
+def test_target_latency_allows_for_max_tokens():
+    short = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", max_tokens=10)
+    long = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", max_tokens=1000)
+    fixed = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", target_latency=2.0)
+
+    assert short.async_cache.concurrency.target_latency < long.async_cache.concurrency.target_latency
+    assert fixed.async_cache.concurrency.target_latency == 2.0
+
+
+def test_async_client_per_event_loop():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+
+    async def client():
+        return lm.async_cache.client
+
+    async def same_client():
+        return lm.async_cache.client is lm.async_cache.client
+
+    # a client, and its pooled connections, never outlives the event loop that opened it
+    first, second = asyncio.run(client()), asyncio.run(client())
+    assert isinstance(first, openai.AsyncOpenAI) and first is not second
+    assert asyncio.run(same_client())
+
+    completions = _FakeChatCompletions()
+    _fake_async_chat(lm.async_cache, completions)
+    assert asyncio.run(lm.abatch(["first"])) == [["FIRST"]]
+    assert asyncio.run(lm.abatch(["second"])) == [["SECOND"]]
+
+
+def test_only_async_responses_are_logged():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    lm.client.chat = _fake_chat(lambda **kwargs: _FakeResponse("sync"))
+    _fake_async_chat(lm.async_cache, _FakeChatCompletions())
+
+    lm("sync prompt")
+    asyncio.run(lm.abatch(["async prompt"]))
+
+    # the synchronous response is persisted by joblib, so only the async one is logged
+    assert gpt3.request_cache_key(lm._prepare_request("sync prompt")) not in gpt3._response_log
+    assert gpt3.request_cache_key(lm._prepare_request("async prompt")) in gpt3._response_log
+
+
+def test_request_cache_key_is_canonical():
+    from dsp.modules.gpt3 import request_cache_key
+
+    key = request_cache_key({"model": "gpt-3.5-turbo", "temperature": 0.0, "prompt": "hi"})
+    same_key = request_cache_key({"prompt": "hi", "temperature": 0.0, "model": "gpt-3.5-turbo"})
+    other_key = request_cache_key({"model": "gpt-3.5-turbo", "temperature": 0.0, "prompt": "hello"})
+
+    assert key == same_key
+    assert key != other_key
+    assert len(key) == 32
+
+
+def test_request_cache_key_accepts_token_id_keys():
+    from dsp.modules.gpt3 import request_cache_key
+
+    key = request_cache_key({"model": "gpt-3.5-turbo", "logit_bias": {50256: -100}, "prompt": "hi"})
+    assert key == request_cache_key({"model": "gpt-3.5-turbo", "logit_bias": {"50256": -100}, "prompt": "hi"})
+
+
+def test_request_cache_key_tracks_static_kwargs():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo-instruct", api_key="fake", model_type="text")
+    from dsp.modules.gpt3 import request_cache_key
+
+    kwargs = lm._prepare_request("hi")
+    assert lm._request_cache_key(kwargs) == request_cache_key(kwargs)
+
+    # overriding a sampling parameter must rehash the static fields
+    kwargs = lm._prepare_request("hi", temperature=0.7)
+    assert lm._request_cache_key(kwargs) == request_cache_key(kwargs)
+    assert lm._request_cache_key(kwargs) != lm._request_cache_key(lm._prepare_request("hi"))
+
+    # 0 == 0.0 == False, but they are different requests
+    keys = [lm._request_cache_key(lm._prepare_request("hi", temperature=t)) for t in (0, 0.0, False)]
+    assert keys == [request_cache_key(lm._prepare_request("hi", temperature=t)) for t in (0, 0.0, False)]
+    assert len(set(keys)) == 3
+
+
+def test_request_cache_key_is_thread_safe():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from dsp.modules.gpt3 import request_cache_key
+
+    lm = dspy.OpenAI(model="gpt-3.5-turbo-instruct", api_key="fake", model_type="text")
+
+    def mismatches(worker):
+        count = 0
+        for i in range(2000):
+            kwargs = lm._prepare_request(f"prompt {i}", temperature=0.7 if (i + worker) % 2 else 0.0)
+            count += lm._request_cache_key(kwargs) != request_cache_key(kwargs)
+        return count
+
+    with ThreadPoolExecutor(4) as executor:
+        assert sum(executor.map(mismatches, range(4))) == 0
+
+
+def test_response_lru_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(gpt3, "RESPONSE_LRU_SIZE", 2)
+
+    gpt3._lru_put("a", {"choices": "a"})
+    gpt3._lru_put("b", {"choices": "b"})
+    assert gpt3._lru_get("a") == {"choices": "a"}
+
+    gpt3._lru_put("c", {"choices": "c"})
+    assert gpt3._lru_get("b") is None
+    assert list(gpt3._response_lru) == ["a", "c"]
+
+
+def test_rate_limiter_honors_headers_and_window():
+    from dsp.modules.gpt3 import RateLimiter
+
+    rate_limiter = RateLimiter()
+    rate_limiter.update({"x-ratelimit-remaining-requests": "5", "x-ratelimit-reset-requests": "30s"})
+    assert rate_limiter.reserve() <= 0
+
+    rate_limiter.update({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1m0s"})
+    assert 59 < rate_limiter.reserve() <= 60
+
+    rate_limiter = RateLimiter(max_requests_per_minute=2)
+    assert rate_limiter.reserve() <= 0
+    assert rate_limiter.reserve() <= 0
+    assert 59 < rate_limiter.reserve() <= 60
+
+
+def test_adaptive_concurrency_limiter_aimd():
+    from dsp.modules.gpt3 import AdaptiveConcurrencyLimiter
+
+    limiter = AdaptiveConcurrencyLimiter(target_latency=1.0, initial_limit=4, window=2)
+
+    async def complete(latency, rate_limited=False):
+        await limiter.acquire()
+        limiter.release(latency, rate_limited)
+
+    async def run():
+        await complete(0.1)
+        await complete(0.2)
+        assert limiter.limit == 5
+
+        await complete(2.0)
+        await complete(2.0)
+        assert limiter.limit == 2
+
+        await complete(0.1, rate_limited=True)
+        assert limiter.limit == 1
+
+        # a window between the target and 1.5x the target keeps the limit and starts a fresh window
+        await complete(1.2)
+        await complete(1.2)
+        assert limiter.limit == 1
+        await complete(0.1)
+        assert limiter.limit == 1
+        await complete(0.1)
+        assert limiter.limit == 2
+        assert limiter._latencies == []
+
+    asyncio.run(run())
+
+
+class _FakeBatchClient:
+    def __init__(self):
+        self.uploaded = None
+        self.jobs = 0
+        self.batches = SimpleNamespace(create=self.create_batch)
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+
+    async def create_file(self, file, purpose):
+        assert purpose == "batch"
+        self.uploaded = [orjson.loads(line) for line in file[1].getvalue().splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    async def create_batch(self, input_file_id, endpoint, completion_window):
+        assert endpoint == "/v1/chat/completions"
+        self.jobs += 1
+        return SimpleNamespace(id="batch-1", status="completed", output_file_id="file-out", error_file_id=None)
+
+    async def file_content(self, file_id):
+        lines = []
+        for request in self.uploaded:
+            content = request["body"]["messages"][-1]["content"].upper()
+            body = _FakeResponse(content).model_dump()
+            lines.append(orjson.dumps({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}}))
+        return SimpleNamespace(text=b"\n".join(lines).decode())
+
+
+def test_abatch_in_batch_mode_submits_one_batch_job():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    client = _FakeBatchClient()
+    _fake_async_client(lm.async_cache, client)
+    lm.batch_mode()
+
+    prompts = [f"prompt {i}" for i in range(3)]
+    results = asyncio.run(lm.abatch(prompts + prompts[:1]))
+
+    assert results == [[p.upper()] for p in prompts + prompts[:1]]
+    assert len(client.uploaded) == len(prompts)
+
+
+def test_abatch_in_batch_mode_waits_for_slow_requests():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    client = _FakeBatchClient()
+    _fake_async_client(lm.async_cache, client)
+    lm.batch_mode()
+
+    batched_request = lm.async_cache.batched_request
+
+    async def slow_batched_request(cache_key, api_kwargs):
+        await asyncio.sleep(0.05)
+        return await batched_request(cache_key, api_kwargs)
+
+    lm.async_cache.batched_request = slow_batched_request
+
+    prompts = [f"prompt {i}" for i in range(3)]
+    results = asyncio.run(lm.abatch(prompts))
+
+    assert results == [[p.upper()] for p in prompts]
+    assert client.jobs == 1
+
+
+def test_abatch_with_legacy_openai(monkeypatch):
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    monkeypatch.setattr(gpt3, "OPENAI_LEGACY", True)
+    monkeypatch.setattr(
+        lm, "basic_request", lambda prompt, **kwargs: {"choices": [{"message": {"content": prompt.upper()}, "finish_reason": "stop"}]},
+    )
+
+    results = asyncio.run(lm.abatch(["a", "b"]))
+
+    assert results == [["A"], ["B"]]
+
+
+class _RateLimitedChatCompletions:
+    def __init__(self):
+        self.calls = 0
+        self.with_raw_response = self
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+        response = httpx.Response(429, request=request, headers={"retry-after": "1"})
+        raise openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_pool_fails_over_to_healthy_endpoint():
+    lm = dspy.OpenAIPool(
+        endpoints=[{"api_key": "key1", "base_url": "http://a/v1/"}, {"api_key": "key2", "base_url": "http://b/v1/"}],
+        model="gpt-3.5-turbo",
+        workers_per_endpoint=2,
+    )
+    limited, healthy = _RateLimitedChatCompletions(), _FakeChatCompletions()
+    _fake_async_chat(lm.endpoints[0], limited)
+    _fake_async_chat(lm.endpoints[1], healthy)
+
+    prompts = [f"prompt {i}" for i in range(6)]
+    results = asyncio.run(lm.abatch(prompts))
+
+    assert results == [[p.upper()] for p in prompts]
+    assert limited.calls >= 1
+
+
+class _SlowRateLimitedChatCompletions(_RateLimitedChatCompletions):
+    async def create(self, **kwargs):
+        await asyncio.sleep(0.01)
+        return await super().create(**kwargs)
+
+
+def test_pool_skips_cooling_endpoint_after_dequeue():
+    lm = dspy.OpenAIPool(
+        endpoints=[{"api_key": "key1", "base_url": "http://a/v1/"}, {"api_key": "key2", "base_url": "http://b/v1/"}],
+        model="gpt-3.5-turbo",
+        workers_per_endpoint=8,
+        max_attempts=5,
+    )
+    limited, healthy = _SlowRateLimitedChatCompletions(), _FakeChatCompletions()
+    _fake_async_chat(lm.endpoints[0], limited)
+    _fake_async_chat(lm.endpoints[1], healthy)
+
+    results = asyncio.run(lm.abatch(["prompt"]))
+
+    assert results == [["PROMPT"]]
+    assert limited.calls == 1
+
+
+def test_pool_copy_keeps_endpoints():
+    endpoints = [{"api_key": "key1", "base_url": "http://a/v1/"}, {"api_key": "key2", "base_url": "http://b/v1/"}]
+    lm = dspy.OpenAIPool(endpoints=endpoints, model="gpt-3.5-turbo", workers_per_endpoint=2, cooldown=1.0)
+
+    copy = lm.copy(temperature=0.7)
+
+    assert isinstance(copy, type(lm))
+    assert copy.endpoint_configs == endpoints and len(copy.endpoints) == 2
+    assert (copy.workers_per_endpoint, copy.cooldown, copy.max_attempts) == (2, 1.0, lm.max_attempts)
+    assert copy.kwargs["temperature"] == 0.7 and copy.kwargs["model"] == "gpt-3.5-turbo"
+
+
+def test_pool_rate_limits_every_endpoint():
+    endpoints = [{"api_key": "key1", "base_url": "http://a/v1/"}, {"api_key": "key2", "base_url": "http://b/v1/"}]
+    lm = dspy.OpenAIPool(endpoints=endpoints, model="gpt-3.5-turbo", max_requests_per_minute=60)
+
+    assert [endpoint.cache.rate_limiter.max_requests_per_minute for endpoint in lm.endpoints] == [60, 60]
+    assert lm.endpoints[0].cache.rate_limiter is not lm.endpoints[1].cache.rate_limiter
+    assert lm.copy().max_requests_per_minute == 60
+
+
+def test_pool_abatch_takes_concurrency_limit_like_gpt3():
+    lm = dspy.OpenAIPool(
+        endpoints=[{"api_key": "key1", "base_url": "http://a/v1/"}, {"api_key": "key2", "base_url": "http://b/v1/"}],
+        model="gpt-3.5-turbo",
+        workers_per_endpoint=4,
+    )
+    completions = _FakeChatCompletions()
+    _fake_async_chat(lm.endpoints[0], completions)
+    _fake_async_chat(lm.endpoints[1], completions)
+
+    prompts = [f"prompt {i}" for i in range(16)]
+    results = asyncio.run(lm.abatch(prompts, 2))
+
+    assert results == [[p.upper()] for p in prompts]
+    assert completions.max_in_flight == 2
+
+
+class _FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def test_streamed_chat_request_stops_at_finish_reason():
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk, Choice, ChoiceDelta
+
+    def chunk(content, finish_reason=None):
+        return ChatCompletionChunk(
+            id="chunk",
+            created=0,
+            model="gpt-3.5-turbo",
+            object="chat.completion.chunk",
+            choices=[Choice(index=0, delta=ChoiceDelta(content=content), finish_reason=finish_reason)],
+        )
+
+    stream = _FakeStream([chunk("Hello"), chunk(", world", "stop"), chunk(None)])
+    raw_response = SimpleNamespace(headers={}, parse=lambda: stream)
+
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", stream=True)
+    lm.client.chat = _fake_chat(lambda **kwargs: raw_response)
+
+    assert lm("prompt") == ["Hello, world"]
+    assert stream.consumed == 2
+    assert stream.closed
+
+
+def test_system_prompt_is_sent():
+    sent = []
+
+    def create(**kwargs):
+        sent.append(kwargs)
+        return _FakeResponse("ok")
+
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", system_prompt="Be brief.")
+    lm.client.chat = _fake_chat(create)
+    prompt = "prompt"
+
+    assert lm(prompt) == ["ok"]
+    assert sent[0]["messages"] == [{"role": "system", "content": "Be brief."}, {"role": "user", "content": prompt}]
+
+
+def test_evict_prefix_drops_responses_sharing_demonstrations():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    lm.client.chat = _fake_chat(lambda **kwargs: _FakeResponse("ok"))
+
+    demos = "Answer questions.\n\n---\n\nQuestion: 1+1?\nAnswer: 2\n\n---\n\n"
+    prompts = [f"{demos}Question: {i}+{i}?\nAnswer:" for i in range(3)]
+    for prompt in prompts:
+        lm(prompt)
+
+    assert lm.evict_prefix(prompts[0]) == 3
+    assert all(gpt3._lru_get(gpt3.request_cache_key(lm._prepare_request(p))) is None for p in prompts)
+
+    # repeated requests come back from the disk cache indexed, so they can be evicted again
+    for prompt in prompts:
+        lm(prompt)
+    assert lm.evict_prefix(prompts[0]) == 3
+
+
+def test_evict_prefix_after_response_log_hits():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    _fake_async_chat(lm.async_cache, _FakeChatCompletions())
+
+    demos = "Answer questions.\n\n---\n\nQuestion: 1+1?\nAnswer: 2\n\n---\n\n"
+    prompts = [f"{demos}Question: {i}+{i}?\nAnswer:" for i in range(3)]
+    asyncio.run(lm.abatch(prompts))
+    assert lm.evict_prefix(prompts[0]) == 3
+
+    # served from the response log this time, without reaching the API
+    completions = _FakeChatCompletions()
+    _fake_async_chat(lm.async_cache, completions)
+    asyncio.run(lm.abatch(prompts))
+    assert completions.max_in_flight == 0
+    assert lm.evict_prefix(prompts[0]) == 3
+
+
+def test_zero_shot_prompts_have_no_prefix():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key")
+    lm.client.chat = _fake_chat(lambda **kwargs: _FakeResponse("ok"))
+
+    for prompt in ["What is 2+2?", "Write a poem"]:
+        assert gpt3.request_prefix_key(lm._prepare_request(prompt)) is None
+        lm(prompt)
+
+    assert lm.evict_prefix("What is 2+2?") == 0
+    assert gpt3._prefix_index == {}
+
+
+def test_history_is_bounded():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo", api_key="key", history_size=2)
+    lm.client.chat = _fake_chat(lambda **kwargs: _FakeResponse(kwargs["messages"][-1]["content"]))
+
+    prompts = [f"prompt {i}" for i in range(3)]
+    for prompt in prompts:
+        lm(prompt)
+
+    assert [entry["prompt"] for entry in lm.history] == prompts[1:]
+    assert prompts[2] in lm.inspect_history(n=1)
+
+
+def test_get_completions_filters_and_ranks_choices():
+    lm = dspy.OpenAI(model="gpt-3.5-turbo-instruct", api_key="fake", model_type="text")
+
+    def choice(text, finish_reason, logprobs):
+        tokens = ["x"] * len(logprobs)
+        return {"text": text, "finish_reason": finish_reason, "logprobs": {"tokens": tokens, "token_logprobs": logprobs}}
+
+    response = {
+        "choices": [
+            choice("low", "stop", [-2.0, -2.0]),
+            choice("cut", "length", [0.0]),
+            choice("high", "stop", [-0.5, -0.1]),
+        ],
+    }
+
+    assert lm._get_completions(response, True, False) == ["low", "high"]
+    assert lm._get_completions(response, False, False) == ["low", "cut", "high"]
+    assert lm._get_completions(response, True, True, n=3) == ["high", "low"]
+    assert lm._get_completions(response, False, True, n=3) == ["cut", "high", "low"]
+
+    truncated = {"choices": [choice("a", "length", [-1.0]), choice("b", "length", [-0.1])]}
+    assert lm._get_completions(truncated, True, False) == ["a", "b"]